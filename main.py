@@ -1,19 +1,82 @@
+"""
+MiniIzi API.
+
+Índices esperados no banco (o schema é mantido fora deste repositório):
+- v_mapa_nomeproduto_norm: a tabela base precisa de índice começando por
+  (pr_nomeProduto, pr_unidade), para o filtro de _SQL_MAPA_PARTE.
+- v_preco_stats_7d / v_preco_stats_90d: a tabela base precisa de índice
+  começando por (pr_nomeNorm, pr_unidade), seguido da coluna de data da
+  janela, para o filtro de _SQL_STATS_PARTE chegar até ela.
+
+As consultas vão contra views, e o MySQL não aceita FORCE/USE INDEX em
+views; por isso os índices ficam na tabela base e o SQL não leva hints.
+preco_media e n são agregados da view (não existem em índice), então o
+ORDER BY preco_media ... LIMIT de cada item ordena no servidor só as
+linhas daquele (pr_nomeNorm, pr_unidade).
+"""
+
+import functools
 import os
-import re
 import hashlib
-from typing import List, Optional, Dict
+import logging
+import threading
+from contextlib import asynccontextmanager
+from typing import List, Optional, Dict, Tuple
 
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+import orjson
 from pydantic import BaseModel
+from starlette.formparsers import MultiPartParser
 
-# XML seguro (recomendado)
-from defusedxml import ElementTree as ET
+# XML: lxml (libxml2) com parser endurecido (sem entidades externas / rede)
+from lxml import etree
 
 load_dotenv()
 
-app = FastAPI(title="MiniIzi API")
+logger = logging.getLogger("miniizi")
+
+
+class OrjsonResponse(JSONResponse):
+    """
+    JSONResponse serializada com orjson (em C). Equivale ao ORJSONResponse
+    do FastAPI, que foi descontinuado. O FastAPI ainda passa o retorno pelo
+    jsonable_encoder antes do render (Decimal/bytes já chegam convertidos):
+    o ganho é só trocar json.dumps por orjson.dumps.
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Startup: cria o pool já aqui. MySQLConnectionPool abre as DB_POOL_SIZE
+    conexões no construtor, então a primeira requisição não paga handshake.
+    Banco fora do ar não pode impedir o deploy: o pool é recriado sob demanda.
+    Shutdown: fecha o cliente httpx do /ip.
+    """
+    try:
+        await run_in_threadpool(_get_pool)
+    except Exception as e:
+        logger.warning("Falha criando o pool MySQL: %s", e)
+
+    yield
+
+    if _HTTPX is not None:
+        await _HTTPX.aclose()
+
+
+app = FastAPI(
+    title="MiniIzi API",
+    default_response_class=OrjsonResponse,
+    lifespan=lifespan,
+)
 
 # ✅ CORS (necessário para o frontend do Lovable chamar a API)
 app.add_middleware(
@@ -29,64 +92,185 @@ VIEW_7D = "v_preco_stats_7d"
 VIEW_90D = "v_preco_stats_90d"
 
 
+# Pool de conexões MySQL (criado uma única vez por processo)
+# Com vários workers (Procfile), cada worker tem o seu pool, criado no
+# startup depois do fork. Máximo de conexões no MySQL:
+#   WEB_CONCURRENCY x (DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW)
+# Com os padrões (4 workers, 10 + 5) são 60, abaixo do max_connections
+# padrão do MySQL (151). Ao subir qualquer um dos três, refaça a conta.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+# Conexões avulsas permitidas além do pool (estilo max_overflow)
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "5"))
+# Espera máxima por uma vaga (pool ou overflow) antes de responder 503
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "2.0"))
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+# Uma vaga por conexão em uso (do pool ou avulsa): limita o total a
+# DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW por processo.
+_DB_VAGAS = threading.BoundedSemaphore(DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW)
+
+
+def _db_config() -> Dict:
+    return {
+        "host": os.getenv("DB_HOST"),
+        "port": int(os.getenv("DB_PORT", "3306")),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASS"),
+        "database": os.getenv("DB_NAME"),
+        "charset": "utf8mb4",
+        "collation": "utf8mb4_general_ci",
+    }
+
+
+def _get_pool():
+    """
+    Cria o pool na primeira chamada (double-checked locking).
+    Se a criação falhar, _POOL continua None e a próxima chamada tenta de novo.
+    """
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                from mysql.connector import pooling  # lazy import
+
+                _POOL = pooling.MySQLConnectionPool(
+                    pool_name="miniizi",
+                    pool_size=DB_POOL_SIZE,
+                    pool_reset_session=False,
+                    **_db_config(),
+                )
+    return _POOL
+
+
+class _ConexaoComVaga:
+    """
+    Repassa tudo para a conexão MySQL; no close() devolve a conexão
+    (ao pool ou fechando a avulsa) e libera a vaga em _DB_VAGAS.
+    A vaga só volta pelo close(): use `with get_conn() as conn:` para
+    não vazar vaga nem conexão quando uma consulta falha.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._vaga = True
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self) -> None:
+        try:
+            self._conn.close()
+        finally:
+            if self._vaga:
+                self._vaga = False
+                _DB_VAGAS.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
 def get_conn():
     """
-    Conexão com MySQL (lazy import):
+    Conexão com MySQL (lazy import + pool):
     - Não importa mysql.connector no topo (evita quebrar deploy).
     - Se o driver não estiver instalado, devolve erro claro.
+    - Pega a conexão do pool; conn.close() devolve ao pool.
+    - Pool esgotado => conexão avulsa (overflow), até DB_POOL_MAX_OVERFLOW.
+    - Sem vaga em DB_POOL_TIMEOUT segundos => 503.
     """
     try:
         import mysql.connector  # lazy import
+        from mysql.connector.errors import PoolError
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"MySQL driver ausente. Instale 'mysql-connector-python'. Detalhe: {e}",
         )
 
-    try:
-        return mysql.connector.connect(
-            host=os.getenv("DB_HOST"),
-            port=int(os.getenv("DB_PORT", "3306")),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASS"),
-            database=os.getenv("DB_NAME"),
-            charset="utf8mb4",
-            collation="utf8mb4_general_ci",
+    if not _DB_VAGAS.acquire(timeout=DB_POOL_TIMEOUT):
+        raise HTTPException(
+            status_code=503,
+            detail="Todas as conexões com o MySQL estão em uso. Tente novamente.",
         )
+
+    try:
+        try:
+            conn = _get_pool().get_connection()
+        except PoolError:
+            # Com a vaga garantida, o pool só esgota se todas as DB_POOL_SIZE
+            # conexões estão em uso: esta é uma das DB_POOL_MAX_OVERFLOW avulsas.
+            return _ConexaoComVaga(mysql.connector.connect(**_db_config()))
     except Exception as e:
+        _DB_VAGAS.release()
         raise HTTPException(status_code=500, detail=f"Erro conectando no MySQL: {e}")
 
+    conn = _ConexaoComVaga(conn)
+
+    # equivalente ao pool_pre_ping: reabre se o servidor derrubou a conexão
+    try:
+        conn.ping(reconnect=True, attempts=1, delay=0)
+    except Exception as e:
+        conn.close()  # devolve ao pool e libera a vaga
+        raise HTTPException(status_code=500, detail=f"Erro conectando no MySQL: {e}")
+    return conn
+
+
+def calcula_hash_xml(xml_bytes: bytes) -> str:
+    """
+    SHA-256 do XML bruto (chave de dedup em xml_bruto.hash_sha256).
+    hashlib usa o SHA-256 do OpenSSL, que já usa as instruções SHA-NI da CPU
+    quando existem, e libera o GIL em buffers grandes.
+    """
+    return hashlib.sha256(xml_bytes).hexdigest()
+
 
 def salva_xml_no_banco(
     xml_bytes: bytes,
     filename: Optional[str],
     content_type: Optional[str],
+    hash_sha256: Optional[str] = None,
 ) -> str:
     """
     Salva o XML bruto no MySQL e retorna o hash SHA-256 (dedup).
     Se já existir, não duplica.
     Requer tabela: xml_bruto (hash_sha256 UNIQUE).
     """
-    h = hashlib.sha256(xml_bytes).hexdigest()
-
-    conn = get_conn()
-    cur = conn.cursor()
+    h = hash_sha256 or calcula_hash_xml(xml_bytes)
+
+    with get_conn() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                """
+                INSERT IGNORE INTO xml_bruto
+                  (hash_sha256, filename, content_type, tamanho_bytes, xml_blob)
+                VALUES
+                  (%s, %s, %s, %s, %s)
+                """,
+                (h, filename, content_type, len(xml_bytes), xml_bytes),
+            )
+            conn.commit()
+        finally:
+            cur.close()
 
-    cur.execute(
-        """
-        INSERT IGNORE INTO xml_bruto
-          (hash_sha256, filename, content_type, tamanho_bytes, xml_blob)
-        VALUES
-          (%s, %s, %s, %s, %s)
-        """,
-        (h, filename, content_type, len(xml_bytes), xml_bytes),
-    )
+    return h
 
-    conn.commit()
-    cur.close()
-    conn.close()
 
-    return h
+def _salva_xml_em_background(
+    xml_bytes: bytes,
+    filename: Optional[str],
+    content_type: Optional[str],
+    hash_sha256: str,
+) -> None:
+    # Roda depois da resposta: não há para quem devolver o erro, só loga.
+    try:
+        salva_xml_no_banco(xml_bytes, filename, content_type, hash_sha256)
+    except Exception as e:
+        logger.error("Falha salvando XML %s no MySQL: %s", hash_sha256, e)
 
 
 @app.get("/health")
@@ -94,47 +278,71 @@ def health():
     return {"ok": True, "service": "miniizi-api"}
 
 
+# IP de saída do Render é estável: busca uma vez por processo
+_IP_CACHE: Optional[str] = None
+_HTTPX = None
+
+
 @app.get("/ip")
-def ip():
+async def ip():
+    global _IP_CACHE, _HTTPX
+    if _IP_CACHE:
+        return {"ip": _IP_CACHE}
+
     try:
-        import requests
+        import httpx  # lazy import
+
+        if _HTTPX is None:
+            _HTTPX = httpx.AsyncClient(timeout=8)
 
-        ip_txt = requests.get("https://api.ipify.org", timeout=8).text.strip()
-        return {"ip": ip_txt}
+        resp = await _HTTPX.get("https://api.ipify.org")
+        resp.raise_for_status()
+        _IP_CACHE = resp.text.strip()
+        return {"ip": _IP_CACHE}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro obtendo IP externo: {e}")
 
 
 @app.get("/health/db")
 def health_db():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT 1")
-    cur.fetchone()
-    cur.close()
-    conn.close()
+    # get_conn() já faz COM_PING na conexão do pool (sem parser, sem
+    # resultset), que é o teste; aqui só devolve a conexão.
+    with get_conn():
+        pass
     return {"ok": True, "db": "ok"}
 
 
 @app.get("/debug/views")
 def list_views():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT table_name
-        FROM information_schema.views
-        WHERE table_schema = %s
-        ORDER BY table_name
-        """,
-        (os.getenv("DB_NAME"),),
-    )
-    rows = [r[0] for r in cur.fetchall()]
-    cur.close()
-    conn.close()
+    with get_conn() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                """
+                SELECT table_name
+                FROM information_schema.views
+                WHERE table_schema = %s
+                ORDER BY table_name
+                """,
+                (os.getenv("DB_NAME"),),
+            )
+            rows = [r[0] for r in cur.fetchall()]
+        finally:
+            cur.close()
     return {"views": rows}
 
 
+class _TabelaSoDigitos(dict):
+    """Tabela p/ str.translate: mantém 0-9 e remove qualquer outro caractere."""
+
+    def __missing__(self, codepoint: int) -> None:
+        return None
+
+
+_SO_DIGITOS = _TabelaSoDigitos((c, c) for c in range(ord("0"), ord("9") + 1))
+
+
+@functools.lru_cache(maxsize=4096)
 def escolhe_view_por_ncm(pr_ncm: Optional[str]) -> str:
     """
     Regra canônica (MVP):
@@ -145,7 +353,12 @@ def escolhe_view_por_ncm(pr_ncm: Optional[str]) -> str:
     if not pr_ncm:
         return VIEW_90D
 
-    digits = re.sub(r"\D", "", str(pr_ncm))
+    # Caminho comum: já vem com 8 dígitos ASCII. Com largura fixa e zeros à
+    # esquerda, comparar strings dá o mesmo resultado que comparar inteiros.
+    if len(pr_ncm) == 8 and pr_ncm.isascii() and pr_ncm.isdigit():
+        return VIEW_7D if pr_ncm <= "08000000" else VIEW_90D
+
+    digits = str(pr_ncm).translate(_SO_DIGITOS)
 
     if len(digits) < 8:
         digits = digits.zfill(8)
@@ -157,6 +370,28 @@ def escolhe_view_por_ncm(pr_ncm: Optional[str]) -> str:
     return VIEW_7D if n <= 8_000_000 else VIEW_90D
 
 
+# Cache do mapeamento (pr_nomeProduto, pr_unidade) -> pr_nomeNorm, por
+# processo (cada worker tem o seu). Pares sem mapeamento ficam num cache à
+# parte com TTL curto, para um mapeamento novo aparecer logo.
+# TTLCache não é thread-safe: todo acesso passa pelo lock.
+_CACHE_NOME_NORM = TTLCache(maxsize=50_000, ttl=3600)
+_CACHE_SEM_MAPA = TTLCache(maxsize=50_000, ttl=60)
+_CACHE_LOCK = threading.Lock()
+
+
+@app.post("/debug/cache_clear")
+def cache_clear():
+    """
+    Limpa os caches só do processo que atendeu (ver "pid"); com vários
+    workers, os outros continuam com o que tinham até o TTL expirar.
+    """
+    with _CACHE_LOCK:
+        _CACHE_NOME_NORM.clear()
+        _CACHE_SEM_MAPA.clear()
+    escolhe_view_por_ncm.cache_clear()
+    return {"ok": True, "escopo": "processo", "pid": os.getpid()}
+
+
 class ItemXML(BaseModel):
     pr_nomeProduto: str
     pr_unidade: str
@@ -170,35 +405,178 @@ class AnalisaRequest(BaseModel):
     n_min: int = 3
 
 
-@app.post("/analisa", tags=["miniizi"])
-def analisa(req: AnalisaRequest):
-    conn = get_conn()
-    cur = conn.cursor(dictionary=True)
+# SQL montado uma vez no import. Cada item vira uma parte entre parênteses,
+# marcada com o índice do item (idx), e as partes vão juntas num único
+# UNION ALL: um round-trip só, quem casa nomes/unidades é o próprio MySQL
+# (com a collation real da coluna) e o ORDER BY ... LIMIT fica no servidor.
+# _SQL_STATS_PARTE só tem as views conhecidas, então nenhum nome de view
+# vindo de fora chega ao SQL.
+_SQL_MAPA_PARTE = """(
+    SELECT %s AS idx, pr_nomeNorm
+    FROM v_mapa_nomeproduto_norm
+    WHERE pr_nomeProduto = %s AND pr_unidade = %s
+    ORDER BY ocorrencias DESC
+    LIMIT 1
+)"""
+
+_SQL_STATS_PARTE_TMPL = """(
+    SELECT
+      %s AS idx,
+      pr_nomeFornecedor,
+      pr_cnpjFornecedor,
+      pr_nomeNorm,
+      pr_unidade,
+      pr_ncm,
+      preco_media,
+      preco_min,
+      n
+    FROM {view}
+    WHERE pr_nomeNorm = %s
+      AND pr_unidade = %s
+      AND n >= %s
+    ORDER BY preco_media ASC
+    LIMIT %s
+)"""
+
+_SQL_STATS_PARTE = {
+    view: _SQL_STATS_PARTE_TMPL.format(view=view) for view in (VIEW_7D, VIEW_90D)
+}
+
+
+# Partes por UNION ALL: mantém cada comando bem abaixo do max_allowed_packet
+# (4 MB no MySQL 5.7) mesmo em requisições com milhares de itens.
+_PARTES_POR_CONSULTA = 500
+
+
+def _lotes(seq: List[tuple]):
+    for ini in range(0, len(seq), _PARTES_POR_CONSULTA):
+        yield seq[ini:ini + _PARTES_POR_CONSULTA]
+
+
+def _consulta_nomes_norm(cur, pares: List[tuple]) -> Dict[tuple, str]:
+    """
+    (pr_nomeProduto, pr_unidade) -> pr_nomeNorm mais frequente, uma consulta
+    por lote de _PARTES_POR_CONSULTA pares.
+    """
+    out: Dict[tuple, str] = {}
+    for lote in _lotes(pares):
+        cur.execute(
+            " UNION ALL ".join([_SQL_MAPA_PARTE] * len(lote)),
+            [v for i, (nome, unidade) in enumerate(lote) for v in (i, nome, unidade)],
+        )
+        out.update((lote[r["idx"]], r["pr_nomeNorm"]) for r in cur.fetchall())
+    return out
 
-    resultados = []
 
-    for item in req.itens:
-        nome_prod = (item.pr_nomeProduto or "").strip()
-        unidade = (item.pr_unidade or "").strip()
+def _resolve_nomes_norm(cur, pares: List[tuple]) -> Dict[tuple, str]:
+    """
+    Igual a _consulta_nomes_norm, mas passando pelo cache: só os pares que
+    não estão no cache vão ao banco. Pares sem mapeamento também são
+    guardados, em _CACHE_SEM_MAPA (TTL curto).
+    """
+    out: Dict[tuple, str] = {}
+    faltando: List[tuple] = []
+
+    with _CACHE_LOCK:
+        for par in pares:
+            nome_norm = _CACHE_NOME_NORM.get(par)
+            if nome_norm is not None:
+                out[par] = nome_norm
+            elif par not in _CACHE_SEM_MAPA:
+                faltando.append(par)
+
+    if faltando:
+        achados = _consulta_nomes_norm(cur, faltando)
+        out.update(achados)
+        with _CACHE_LOCK:
+            for par in faltando:
+                if par in achados:
+                    _CACHE_NOME_NORM[par] = achados[par]
+                else:
+                    _CACHE_SEM_MAPA[par] = True
+
+    return out
 
-        view_stats = escolhe_view_por_ncm(item.pr_ncm)
 
+def _busca_fornecedores(
+    cur,
+    consultas: List[tuple],
+    n_min: int,
+    limite_fornecedores: int,
+) -> Dict[tuple, List[Dict]]:
+    """
+    (view, pr_nomeNorm, pr_unidade) -> os limite_fornecedores fornecedores
+    mais baratos. As duas views vão juntas, uma ida ao banco por lote de
+    _PARTES_POR_CONSULTA consultas.
+    """
+    grupos: Dict[tuple, List[Dict]] = {}
+    for lote in _lotes(consultas):
         cur.execute(
-            """
-            SELECT pr_nomeNorm, ocorrencias
-            FROM v_mapa_nomeproduto_norm
-            WHERE pr_nomeProduto = %s AND pr_unidade = %s
-            ORDER BY ocorrencias DESC
-            LIMIT 1
-            """,
-            (nome_prod, unidade),
+            " UNION ALL ".join(_SQL_STATS_PARTE[view] for view, _, _ in lote)
+            + " ORDER BY idx, preco_media ASC",
+            [
+                v
+                for i, (_, nome_norm, unidade) in enumerate(lote)
+                for v in (i, nome_norm, unidade, n_min, limite_fornecedores)
+            ],
         )
-        row_map = cur.fetchone()
+        for r in cur.fetchall():
+            grupos.setdefault(lote[r.pop("idx")], []).append(r)
+    return grupos
+
 
-        if not row_map:
+def _analisa_core(
+    conn,
+    itens: List[Dict],
+    n_min: int,
+    limite_fornecedores: int,
+) -> List[Dict]:
+    """
+    Análise de todos os itens com 1 consulta de mapeamento + 1 consulta de
+    fornecedores (as duas views juntas) por lote de _PARTES_POR_CONSULTA
+    itens, em vez de 2 consultas por item.
+    Itens são dicts com pr_nomeProduto / pr_unidade / pr_ncm; a conexão é do
+    chamador (não é fechada aqui).
+    """
+    entradas = [
+        (
+            (it.get("pr_nomeProduto") or "").strip(),
+            (it.get("pr_unidade") or "").strip(),
+            escolhe_view_por_ncm(it.get("pr_ncm") or None),
+        )
+        for it in itens
+    ]
+    if not entradas:
+        return []
+
+    # Cursor texto de propósito (não prepared=True): os UNION ALL mudam de
+    # tamanho a cada requisição, então o PREPARE não seria reaproveitado e
+    # só custaria um round-trip a mais por consulta.
+    cur = conn.cursor(dictionary=True)
+
+    try:
+        pares = list(dict.fromkeys((nome, unidade) for nome, unidade, _ in entradas))
+        nomes_norm = _resolve_nomes_norm(cur, pares)
+
+        consultas = list(
+            dict.fromkeys(
+                (view_stats, nomes_norm[(nome, unidade)], unidade)
+                for nome, unidade, view_stats in entradas
+                if (nome, unidade) in nomes_norm
+            )
+        )
+        grupos = _busca_fornecedores(cur, consultas, n_min, limite_fornecedores)
+    finally:
+        cur.close()
+
+    resultados = []
+    for nome, unidade, view_stats in entradas:
+        nome_norm = nomes_norm.get((nome, unidade))
+
+        if nome_norm is None:
             resultados.append(
                 {
-                    "pr_nomeProduto": nome_prod,
+                    "pr_nomeProduto": nome,
                     "pr_unidade": unidade,
                     "status": "SEM_MAPEAMENTO",
                     "fornecedores": [],
@@ -206,34 +584,12 @@ def analisa(req: AnalisaRequest):
             )
             continue
 
-        nome_norm = row_map["pr_nomeNorm"]
-
-        cur.execute(
-            f"""
-            SELECT
-              pr_nomeFornecedor,
-              pr_cnpjFornecedor,
-              pr_nomeNorm,
-              pr_unidade,
-              pr_ncm,
-              preco_media,
-              preco_min,
-              n
-            FROM {view_stats}
-            WHERE pr_nomeNorm = %s
-              AND pr_unidade = %s
-              AND n >= %s
-            ORDER BY preco_media ASC
-            LIMIT %s
-            """,
-            (nome_norm, unidade, req.n_min, req.limite_fornecedores),
-        )
-        fornecedores = cur.fetchall()
+        fornecedores = grupos.get((view_stats, nome_norm, unidade), [])
 
         if not fornecedores:
             resultados.append(
                 {
-                    "pr_nomeProduto": nome_prod,
+                    "pr_nomeProduto": nome,
                     "pr_unidade": unidade,
                     "pr_nomeNorm": nome_norm,
                     "status": "DADOS_INSUFICIENTES",
@@ -244,7 +600,7 @@ def analisa(req: AnalisaRequest):
 
         resultados.append(
             {
-                "pr_nomeProduto": nome_prod,
+                "pr_nomeProduto": nome,
                 "pr_unidade": unidade,
                 "pr_nomeNorm": nome_norm,
                 "status": "OK",
@@ -252,8 +608,29 @@ def analisa(req: AnalisaRequest):
             }
         )
 
-    cur.close()
-    conn.close()
+    return resultados
+
+
+def _analisa_itens(
+    itens: List[Dict],
+    n_min: int,
+    limite_fornecedores: int,
+) -> List[Dict]:
+    if not itens:
+        return []
+
+    with get_conn() as conn:
+        return _analisa_core(conn, itens, n_min, limite_fornecedores)
+
+
+@app.post("/analisa", tags=["miniizi"])
+async def analisa(req: AnalisaRequest):
+    resultados = await run_in_threadpool(
+        _analisa_itens,
+        [it.model_dump() for it in req.itens],
+        req.n_min,
+        req.limite_fornecedores,
+    )
     return {"itens": resultados}
 
 
@@ -261,59 +638,123 @@ def analisa(req: AnalisaRequest):
 # Parse de XML NF-e / NFC-e
 # ----------------------------
 
-def _strip_ns(tag: str) -> str:
-    return tag.split("}", 1)[-1] if "}" in tag else tag
+# XPaths compiladas uma vez; local-name() ignora o namespace da NF-e
+_XP_XPROD = etree.XPath("string(*[local-name()='prod'][1]/*[local-name()='xProd'][1])")
+_XP_UCOM = etree.XPath("string(*[local-name()='prod'][1]/*[local-name()='uCom'][1])")
+_XP_NCM = etree.XPath("string(*[local-name()='prod'][1]/*[local-name()='NCM'][1])")
 
 
-def _findall_no_ns(root, wanted: str):
-    return [el for el in root.iter() if _strip_ns(el.tag) == wanted]
+# Leitura do upload em blocos; arquivos até 4 MB ficam em memória
+# (SpooledTemporaryFile), sem ir para o disco
+_XML_CHUNK = 64 * 1024
+MultiPartParser.spool_max_size = 4 * 1024 * 1024
 
 
-def parse_nfe_itens(xml_bytes: bytes) -> List[Dict]:
-    try:
-        root = ET.fromstring(xml_bytes)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"XML inválido: {e}")
-
-    det_nodes = _findall_no_ns(root, "det")
-    itens: List[Dict] = []
+# Como no defusedxml, XML com DOCTYPE é recusado: resolve_entities=False
+# não impede entidades internas de serem expandidas no texto lido pelas
+# XPaths. A busca é nos bytes, então o parser fica preso em UTF-8 (o padrão
+# da NF-e): outro encoding (ex.: UTF-16) não passa pela busca nem pelo parser.
+_DOCTYPE = b"<!DOCTYPE"
 
-    for det in det_nodes:
-        prod_nodes = [n for n in det.iter() if _strip_ns(n.tag) == "prod"]
-        if not prod_nodes:
-            continue
-        prod = prod_nodes[0]
 
-        def get_text(tagname: str) -> Optional[str]:
-            for n in prod.iter():
-                if _strip_ns(n.tag) == tagname:
-                    return (n.text or "").strip()
-            return None
+def _novo_parser_nfe():
+    return etree.XMLPullParser(
+        events=("end",),
+        tag="{*}det",
+        encoding="utf-8",
+        resolve_entities=False,
+        no_network=True,
+    )
 
-        xprod = get_text("xProd") or ""
-        ucom = get_text("uCom") or ""
-        ncm = get_text("NCM") or ""
 
+def _coleta_itens(parser, itens: List[Dict]) -> None:
+    """
+    Consome os <det> já fechados: cada um é processado e depois descartado
+    junto com os irmãos anteriores, então a memória não cresce com o XML.
+    """
+    for _, det in parser.read_events():
+        xprod = _XP_XPROD(det).strip()
         if xprod:
             itens.append(
                 {
                     "pr_nomeProduto": xprod,
-                    "pr_unidade": ucom,
-                    "pr_ncm": ncm,
+                    "pr_unidade": _XP_UCOM(det).strip(),
+                    "pr_ncm": _XP_NCM(det).strip(),
                 }
             )
 
+        det.clear()
+        while det.getprevious() is not None:
+            del det.getparent()[0]
+
+
+async def recebe_xml(
+    xml: UploadFile,
+    background_tasks: BackgroundTasks,
+) -> Tuple[str, List[Dict]]:
+    """
+    Lê o upload uma única vez, em blocos: cada bloco vai para o SHA-256 e
+    para o parser ao mesmo tempo. Agenda o salvamento do XML bruto em
+    background e retorna (hash_xml, itens).
+    """
+    hasher = hashlib.sha256()
+    parser = _novo_parser_nfe()
+    partes: List[bytes] = []
+    itens: List[Dict] = []
+    erro: Optional[Exception] = None
+    cauda = b""
+
+    # Mesmo com XML inválido, lê até o fim: o XML bruto é salvo de qualquer forma.
+    while chunk := await xml.read(_XML_CHUNK):
+        partes.append(chunk)
+        hasher.update(chunk)
+        if erro is None:
+            # cauda: "<!DOCTYPE" pode vir partido entre dois blocos
+            if _DOCTYPE in chunk or _DOCTYPE in cauda + chunk[: len(_DOCTYPE)]:
+                erro = ValueError("DOCTYPE/DTD não é permitido")
+            else:
+                try:
+                    parser.feed(chunk)
+                    _coleta_itens(parser, itens)
+                except Exception as e:
+                    erro = e
+        cauda = chunk[-len(_DOCTYPE):]
+
+    if erro is None:
+        try:
+            parser.close()
+            _coleta_itens(parser, itens)
+        except Exception as e:
+            erro = e
+
+    hash_xml = hasher.hexdigest()
+    background_tasks.add_task(
+        _salva_xml_em_background,
+        b"".join(partes),
+        getattr(xml, "filename", None),
+        getattr(xml, "content_type", None),
+        hash_xml,
+    )
+
+    if erro is not None or not itens:
+        # Resposta de erro não dispara background tasks: salva antes de sair.
+        await background_tasks()
+
+    if erro is not None:
+        raise HTTPException(status_code=400, detail=f"XML inválido: {erro}")
+
     if not itens:
         raise HTTPException(
             status_code=422,
             detail="Não encontrei itens no XML (estrutura NF-e esperada).",
         )
 
-    return itens
+    return hash_xml, itens
 
 
 @app.post("/analisa_xml", tags=["miniizi"])
 async def analisa_xml(
+    background_tasks: BackgroundTasks,
     xml: UploadFile = File(...),
     limite_fornecedores: int = 5,
     n_min: int = 3,
@@ -321,19 +762,11 @@ async def analisa_xml(
     """
     Pipeline 1:
     - Recebe XML real
-    - Salva XML bruto no MySQL (dedup por hash)
+    - Salva XML bruto no MySQL (dedup por hash), em background
     - Extrai itens do XML
     - Retorna itens_extraidos + hash_xml
     """
-    xml_bytes = await xml.read()
-
-    hash_xml = salva_xml_no_banco(
-        xml_bytes=xml_bytes,
-        filename=getattr(xml, "filename", None),
-        content_type=getattr(xml, "content_type", None),
-    )
-
-    itens = parse_nfe_itens(xml_bytes)
+    hash_xml, itens = await recebe_xml(xml, background_tasks)
 
     return {
         "ok": True,
@@ -347,6 +780,7 @@ async def analisa_xml(
 
 @app.post("/analisa_xml_full", tags=["miniizi"])
 async def analisa_xml_full(
+    background_tasks: BackgroundTasks,
     xml: UploadFile = File(...),
     limite_fornecedores: int = 5,
     n_min: int = 3,
@@ -354,37 +788,17 @@ async def analisa_xml_full(
     """
     Pipeline 2:
     - Recebe XML real
-    - Salva XML bruto no MySQL (dedup por hash)
+    - Salva XML bruto no MySQL (dedup por hash), em background
     - Extrai itens do XML
     - Roda a análise completa (MySQL + views 7d/90d)
     - Retorna {"itens": [...]} + hash_xml
     """
-    xml_bytes = await xml.read()
-
     # ✅ NOVO (Tarefa 4): salvar também no full
-    hash_xml = salva_xml_no_banco(
-        xml_bytes=xml_bytes,
-        filename=getattr(xml, "filename", None),
-        content_type=getattr(xml, "content_type", None),
-    )
+    hash_xml, itens_extraidos = await recebe_xml(xml, background_tasks)
 
-    itens_extraidos = parse_nfe_itens(xml_bytes)
-
-    req = AnalisaRequest(
-        itens=[
-            ItemXML(
-                pr_nomeProduto=(it.get("pr_nomeProduto") or "").strip(),
-                pr_unidade=(it.get("pr_unidade") or "").strip(),
-                pr_ncm=(it.get("pr_ncm") or None),
-            )
-            for it in itens_extraidos
-            if (it.get("pr_nomeProduto") or "").strip()
-        ],
-        limite_fornecedores=limite_fornecedores,
-        n_min=n_min,
-        janela_padrao_dias=30,
+    # recebe_xml já devolve dicts limpos (xProd não vazio): vai direto
+    # para o núcleo, sem reconstruir/validar ItemXML / AnalisaRequest
+    resultados = await run_in_threadpool(
+        _analisa_itens, itens_extraidos, n_min, limite_fornecedores
     )
-
-    out = analisa(req)
-    out["hash_xml"] = hash_xml
-    return out
+    return {"itens": resultados, "hash_xml": hash_xml}